@@ -0,0 +1,58 @@
+import duckdb
+from pathlib import Path
+from loguru import logger
+
+# Cached DuckDB connections, keyed by resolved database file path: (connection, read_only)
+_connections = {}
+
+
+def get_connection(database_path, read_only=False):
+    """
+    Get a cached DuckDB connection, opening it on first use.
+
+    Args:
+        database_path (str): Path to the DuckDB database file, or ':memory:' for a new,
+                             uncached in-memory database.
+        read_only (bool): Whether a read-only connection is sufficient.
+
+    Returns:
+        duckdb.DuckDBPyConnection: The cached connection for the database.
+
+    Raises:
+        duckdb.ConnectionException: If a writable connection is requested while the
+                                    database is cached read-only.
+    """
+    if str(database_path) == ":memory:":
+        logger.info("Connecting to in-memory DuckDB database...")
+        return duckdb.connect(database=":memory:")
+
+    key = str(Path(database_path).resolve())
+
+    if key in _connections:
+        con, cached_read_only = _connections[key]
+        if read_only or not cached_read_only:
+            return con
+        # DuckDB can't open the file writable alongside the read-only connection, and
+        # closing that connection here would break callers still holding it
+        raise duckdb.ConnectionException(
+            f"DuckDB database '{database_path}' is already open read-only. "
+            "Call close_connection() first to reopen it writable."
+        )
+
+    logger.info(f"Connecting to DuckDB database at '{database_path}'...")
+    con = duckdb.connect(database=str(database_path), read_only=read_only)
+    _connections[key] = (con, read_only)
+    return con
+
+
+def close_connection(database_path):
+    """
+    Close and forget the cached DuckDB connection for a database, if any.
+
+    Args:
+        database_path (str): Path to the DuckDB database file.
+    """
+    cached = _connections.pop(str(Path(database_path).resolve()), None)
+    if cached is not None:
+        logger.info(f"Closing DuckDB database at '{database_path}'...")
+        cached[0].close()
@@ -1,84 +1,112 @@
-import duckdb
+from concurrent.futures import ThreadPoolExecutor
+import os
 from pathlib import Path
+from tempfile import NamedTemporaryFile
 from loguru import logger
+from _db import get_connection
 
 # Define the database path
 DATA_DIR = Path("data")
 DATABASE_PATH = DATA_DIR / "sales.duckdb"
+FETCH_BATCH_SIZE = 1000  # Tables fetched per batch while streaming the ERD
+WRITE_BUFFER_SIZE = 1 << 20  # Output file buffer size in bytes
 
 
-def generate_mermaid_erd(database_path):
+def generate_mermaid_erd(database_path, out_path):
     """
-    Generate a Mermaid ERD from DuckDB tables.
+    Generate a Mermaid ERD from DuckDB tables, streaming it into a file.
 
     Args:
         database_path (Path): Path to the DuckDB database file.
+        out_path (Path): Path of the file to write the Mermaid ERD diagram to.
 
     Returns:
-        str: Mermaid ERD diagram as a string.
+        Path: Path of the written Mermaid ERD diagram.
     """
-    logger.info(f"Connecting to DuckDB database at '{database_path}'...")
-    con = duckdb.connect(database=str(database_path), read_only=True)
+    con = get_connection(database_path, read_only=True)
 
-    # Query for table and column metadata
-    logger.info("Fetching table and column metadata...")
+    # Query for table and column metadata straight from duckdb_columns(), which avoids the
+    # information_schema view and reports real columns for attached remote catalogs too,
+    # letting DuckDB format each "type name" column line and group them per table
     table_columns_query = """
-        SELECT 
-            table_name, 
-            column_name, 
-            data_type 
-        FROM information_schema.columns
-        WHERE table_schema = 'main'
-        ORDER BY table_name, ordinal_position;
+        SELECT
+            table_name,
+            list(
+                -- Mermaid types are single words, so drop type parameters
+                -- such as ENUM members or DECIMAL precision
+                split_part(lower(data_type), '(', 1) || ' ' || column_name
+                ORDER BY column_index
+            ) AS columns
+        FROM duckdb_columns()
+        WHERE schema_name = 'main' AND NOT internal
+        GROUP BY table_name
+        ORDER BY table_name;
     """
-    table_columns = con.execute(table_columns_query).fetchall()
 
-    # Query for foreign key relationships
-    logger.info("Fetching foreign key relationships...")
+    # Query for foreign key relationships straight from duckdb_constraints(), one row
+    # per (composite) key column
     foreign_keys_query = """
-        SELECT 
-            fk_table.table_name AS from_table,
-            fk_column.column_name AS from_column,
-            pk_table.table_name AS to_table,
-            pk_column.column_name AS to_column
-        FROM information_schema.referential_constraints rc
-        JOIN information_schema.key_column_usage fk_column
-            ON rc.constraint_name = fk_column.constraint_name
-        JOIN information_schema.table_constraints fk_table
-            ON fk_column.table_name = fk_table.table_name AND fk_table.constraint_type = 'FOREIGN KEY'
-        JOIN information_schema.key_column_usage pk_column
-            ON rc.unique_constraint_name = pk_column.constraint_name
-        JOIN information_schema.table_constraints pk_table
-            ON pk_column.table_name = pk_table.table_name AND pk_table.constraint_type = 'PRIMARY KEY'
-        WHERE fk_table.table_schema = 'main' AND pk_table.table_schema = 'main';
+        SELECT
+            table_name AS from_table,
+            unnest(constraint_column_names) AS from_column,
+            referenced_table AS to_table,
+            unnest(referenced_column_names) AS to_column
+        FROM duckdb_constraints()
+        WHERE constraint_type = 'FOREIGN KEY' AND schema_name = 'main'
+        ORDER BY table_name;
     """
-    foreign_keys = con.execute(foreign_keys_query).fetchall()
 
-    # Start building the Mermaid diagram
-    mermaid_diagram = ["erDiagram"]
-
-    # Add tables and columns to the diagram
-    logger.info("Adding tables and columns to the diagram...")
-    tables = {}
-    for table, column, data_type in table_columns:
-        if table not in tables:
-            tables[table] = []
-        tables[table].append(f"{data_type.lower()} {column}")
-
-    for table, columns in tables.items():
-        mermaid_diagram.append(f"  {table} {{")
-        mermaid_diagram.extend([f"    {col}" for col in columns])
-        mermaid_diagram.append("  }")
-
-    # Add relationships to the diagram
-    logger.info("Adding relationships to the diagram...")
-    for from_table, from_column, to_table, to_column in foreign_keys:
-        mermaid_diagram.append(
-            f'  {from_table} }}o--o{{ {to_table} : "{from_column} -> {to_column}"'
-        )
-
-    # Combine all lines into a single Mermaid diagram string
-    return "\n".join(mermaid_diagram)
+    def fetch_all(query):
+        with con.cursor() as cursor:
+            return cursor.execute(query).fetchall()
+
+    # The two metadata queries are independent, so fetch the foreign keys on a separate
+    # cursor while the tables and columns stream into the output file. The diagram is
+    # streamed into a temporary file next to it, so a failure never truncates an
+    # existing diagram
+    logger.info("Fetching table, column and foreign key metadata...")
+    out_path = Path(out_path)
+    tmp_file = NamedTemporaryFile(
+        "w", dir=out_path.parent, delete=False, buffering=WRITE_BUFFER_SIZE
+    )
+    try:
+        with (
+            ThreadPoolExecutor(max_workers=1) as executor,
+            con.cursor() as cursor,
+            tmp_file as out_file,
+        ):
+            foreign_keys_future = executor.submit(fetch_all, foreign_keys_query)
+            cursor.execute(table_columns_query)
+
+            # Start the Mermaid diagram, writing each line straight to the file
+            write = out_file.write
+            write("erDiagram")
+
+            # Add tables and columns to the diagram, a batch of tables at a time
+            logger.info("Adding tables and columns to the diagram...")
+            while tables := cursor.fetchmany(FETCH_BATCH_SIZE):
+                for table, columns in tables:
+                    write(f"\n  {table} {{\n    " + "\n    ".join(columns) + "\n  }")
+
+            # Add relationships to the diagram
+            logger.info("Adding relationships to the diagram...")
+            foreign_keys = foreign_keys_future.result()
+            for from_table, from_column, to_table, to_column in foreign_keys:
+                write(
+                    f"\n  {from_table} }}o--o{{ {to_table} : "
+                    f'"{from_column} -> {to_column}"'
+                )
+
+        # Temporary files are owner-only; give the diagram the mode a plain open() would
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_file.name, 0o666 & ~umask)
+        os.replace(tmp_file.name, out_path)
+    except BaseException:
+        Path(tmp_file.name).unlink(missing_ok=True)
+        raise
+
+    return out_path
 
 
 def main():
@@ -87,16 +115,12 @@ def main():
         return
 
     logger.info("Generating Mermaid ERD...")
-    erd_diagram = generate_mermaid_erd(DATABASE_PATH)
-
-    # Save the Mermaid diagram to a file (optional)
-    output_file = Path("er-diagram.mermaid")
-    output_file.write_text(erd_diagram)
+    output_file = generate_mermaid_erd(DATABASE_PATH, Path("er-diagram.mermaid"))
     logger.info(f"Mermaid ERD saved to '{output_file}'.")
 
     # Print the Mermaid diagram
     print("\nGenerated Mermaid ERD:")
-    print(erd_diagram)
+    print(output_file.read_text())
 
 
 if __name__ == "__main__":
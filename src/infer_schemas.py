@@ -1,11 +1,20 @@
-import sqlglot
+import hashlib
+import inspect
+import json
+import os
 import duckdb
 from pathlib import Path
+import sqlglot
+from sqlglot import exp
+from tempfile import NamedTemporaryFile
 from loguru import logger
+from _db import close_connection, get_connection
 
 # Infer schemas for each table based on their structure and generate a Puppini Bridge query dynamically.
 
 DATA_DIR = Path("data")  # Directory containing the CSV files
+SCHEMA_CACHE_DIR = Path(".cache") / "schemas"  # Inferred schemas, keyed by database state
+BRIDGE_CACHE_DIR = Path(".cache") / "bridge"  # Generated bridge SQL, keyed by schemas
 
 # Define table names to infer schemas from DuckDB tables dynamically
 tables = [
@@ -18,73 +27,246 @@ tables = [
 ]
 
 
-def infer_schemas_and_generate_puppini_bridge_sql(tables, database_path):
+def _write_text_atomic(path, text):
     """
-    Infer schemas from DuckDB tables and generate a Puppini Bridge SQL query.
+    Write text to a file atomically, so readers never see a partially written file.
+
+    Args:
+        path (Path): Destination file path.
+        text (str): Content to write.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with NamedTemporaryFile("w", dir=path.parent, delete=False) as tmp_file:
+        tmp_file.write(text)
+    # Temporary files are owner-only; give the file the mode a plain open() would
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_file.name, 0o666 & ~umask)
+    os.replace(tmp_file.name, path)
+
+
+def _cache_file(cache_dir, identity, state):
+    """
+    Get the cache file for an entry, named by hashes of its identity and state.
+
+    Args:
+        cache_dir (Path): Directory holding the cache entries.
+        identity (str): What the entry is for; entries sharing it replace each other.
+        state (str): What the cached value depends on; any change makes a new entry.
+
+    Returns:
+        Path: Path of the cache file.
+    """
+    identity_key = hashlib.blake2b(identity.encode(), digest_size=16).hexdigest()
+    state_key = hashlib.blake2b(state.encode(), digest_size=16).hexdigest()
+    return cache_dir / f"{identity_key}-{state_key}.json"
+
+
+def _write_cache_file(cache_file, text):
+    """
+    Write a cache entry atomically, removing older entries with the same identity.
+
+    Args:
+        cache_file (Path): Cache file path from `_cache_file`.
+        text (str): Content to cache.
+    """
+    identity_key = cache_file.name.split("-", 1)[0]
+    for stale_file in cache_file.parent.glob(f"{identity_key}-*.json"):
+        if stale_file != cache_file:
+            stale_file.unlink(missing_ok=True)
+    _write_text_atomic(cache_file, text)
+
+
+def infer_schemas(tables, database_path):
+    """
+    Infer column names and types of DuckDB tables.
+
+    Metadata is read over a read-only connection and cached under `.cache/schemas`
+    until the database (or its WAL file) is next written.
 
     Args:
         tables (list): List of table names to infer schemas from.
-        database_path (str): Path to the DuckDB database file. Default is in-memory (':memory:').
+        database_path (str): Path to the DuckDB database file.
 
     Returns:
-        str: Generated Puppini Bridge SQL query.
+        dict: Mapping of table name to a dict of column name to data type.
     """
 
+    if not tables:
+        return {}
+
     if not Path(database_path).exists():
         raise FileNotFoundError(f"Database file '{database_path}' does not exist!")
     else:
         logger.info(f"Database file '{database_path}' exists.")
 
-    logger.info(f"Connecting to DuckDB database at '{database_path}'...")
-    con = duckdb.connect(database=database_path, read_only=False)
+    # Uncheckpointed changes live in the WAL file and don't touch the database's mtime
+    wal_path = Path(f"{database_path}.wal")
+    wal_mtime = os.path.getmtime(wal_path) if wal_path.exists() else None
+    cache_file = _cache_file(
+        SCHEMA_CACHE_DIR,
+        f"{Path(database_path).resolve()}:{','.join(tables)}",
+        f"{os.path.getmtime(database_path)}:{wal_mtime}",
+    )
+
+    if cache_file.exists():
+        logger.info(f"Using cached schemas from '{cache_file}'.")
+        return json.loads(cache_file.read_text())
 
-    # Infer schemas by querying column names and types from DuckDB's information schema
-    schemas = {}
-    for table in tables:
-        schema_query = f"PRAGMA table_info({table})"
-        columns = con.execute(schema_query).fetchall()
-        schemas[table] = {
-            col[1]: col[2] for col in columns
-        }  # col[1]: name; col[2]: type
+    # Infer schemas by querying column names and types for all tables in one scan of
+    # DuckDB's catalog, keeping tables in the order and spelling they were requested;
+    # names match case-insensitively, like DuckDB identifiers
+    placeholders = ", ".join("?" * len(tables))
+    schema_query = f"""
+        SELECT lower(table_name), column_name, data_type
+        FROM duckdb_columns()
+        WHERE schema_name = 'main' AND lower(table_name) IN ({placeholders})
+        ORDER BY table_name, column_index
+    """
+    con = get_connection(database_path, read_only=True)
+    requested_tables = {table.lower(): table for table in tables}
+    columns = con.execute(schema_query, list(requested_tables)).fetchall()
+    schemas = {table: {} for table in tables}
+    for table, column_name, data_type in columns:
+        schemas[requested_tables[table]][column_name] = data_type
+
+    missing_tables = [table for table, columns in schemas.items() if not columns]
+    if missing_tables:
+        raise duckdb.CatalogException(
+            f"Tables {missing_tables} do not exist in database '{database_path}'!"
+        )
+
+    _write_cache_file(cache_file, json.dumps(schemas))
+    logger.info(f"Cached inferred schemas to '{cache_file}'.")
+
+    return schemas
+
+
+def infer_primary_keys(database_path):
+    """
+    Infer primary key columns for all tables from DuckDB's declared constraints.
+
+    Args:
+        database_path (str): Path to the DuckDB database file.
+
+    Returns:
+        dict: Mapping of table name to its (first) primary key column. Tables without a
+              declared primary key are omitted.
+    """
+    primary_keys_query = """
+        SELECT table_name, constraint_column_names[1]
+        FROM duckdb_constraints()
+        WHERE constraint_type = 'PRIMARY KEY' AND schema_name = 'main'
+    """
+    con = get_connection(database_path, read_only=True)
+    return dict(con.execute(primary_keys_query).fetchall())
 
-    return con, schemas
 
+# Table macro that produces the Puppini Bridge rows for one table, letting DuckDB resolve
+# the table and its key column via query_table() and COLUMNS() when planning the query
+BRIDGE_ROW_MACRO = (
+    "CREATE OR REPLACE TEMP MACRO bridge_row(t, pk) AS TABLE "
+    "SELECT CAST(COLUMNS(c -> c = pk) AS VARCHAR) AS _KEY, t AS Stage FROM query_table(t)"
+)
 
 # Generate Puppini Bridge SQL using SQLGlot based on inferred schemas
 
 
-def generate_puppini_bridge_sql(schemas):
-    union_queries = []
+def generate_puppini_bridge_sql(schemas, primary_keys=None):
+    """
+    Generate the SQL statements that create and populate the Puppini Bridge table.
+
+    The bridge is created empty and then filled with one INSERT per table. Statements
+    are cached under `.cache/bridge` until the inputs or the generating code change.
+
+    Args:
+        schemas (dict): Mapping of table name to a dict of column name to data type.
+        primary_keys (dict): Optional mapping of table name to its primary key column.
+                             Tables without one fall back to their first column.
+
+    Returns:
+        list: SQL statements to execute in order.
+    """
+    primary_keys = primary_keys or {}
+
+    # Table order determines the generated SQL, so hash the schemas without sorting;
+    # the generator's source and the sqlglot version that renders it are hashed too
+    generator_state = [
+        inspect.getsource(generate_puppini_bridge_sql),
+        BRIDGE_ROW_MACRO,
+        sqlglot.__version__,
+    ]
+    cache_file = _cache_file(
+        BRIDGE_CACHE_DIR,
+        ",".join(schemas),
+        json.dumps([generator_state, schemas, primary_keys]),
+    )
+
+    if cache_file.exists():
+        logger.info(f"Using cached Puppini Bridge SQL from '{cache_file}'.")
+        return json.loads(cache_file.read_text())
+
+    # Stage is a dictionary-encoded ENUM of all table names rather than a repeated string
+    stage_type = exp.DataType(
+        this=exp.DataType.Type.ENUM,
+        expressions=[exp.Literal.string(table_name) for table_name in schemas],
+    )
+    create_table = exp.Create(
+        this=exp.Schema(
+            this=exp.to_table("puppini_bridge"),
+            expressions=[
+                exp.ColumnDef(
+                    this=exp.to_identifier("_KEY"), kind=exp.DataType.build("VARCHAR")
+                ),
+                exp.ColumnDef(this=exp.to_identifier("Stage"), kind=stage_type),
+            ],
+        ),
+        kind="TABLE",
+        replace=True,
+    )
+    statements = [BRIDGE_ROW_MACRO, create_table.sql(dialect="duckdb")]
+
     for table_name, columns in schemas.items():
-        logger.info(f"Generating SELECT query for table '{table_name}'...")
-        primary_key = list(columns.keys())[
-            0
-        ]  # Assume first column is the primary key (e.g., sale_id)
-        select_query = f"SELECT CAST({primary_key} AS VARCHAR) AS _KEY_{table_name}, '{table_name}' AS Stage FROM {table_name}"
-        union_queries.append(select_query)
-        logger.info(f"Generated SELECT query: {select_query}")
+        logger.info(f"Generating INSERT query for table '{table_name}'...")
+        # Use the declared primary key, falling back to the first column (e.g., sale_id)
+        primary_key = primary_keys.get(table_name) or next(iter(columns))
+        bridge_row = exp.Anonymous(
+            this="bridge_row",
+            expressions=[exp.Literal.string(table_name), exp.Literal.string(primary_key)],
+        )
+        insert_query = exp.insert(
+            exp.select("*").from_(exp.Table(this=bridge_row)), "puppini_bridge"
+        )
+        insert_query.set("by_name", True)
+        statements.append(insert_query.sql(dialect="duckdb"))
+        logger.info(f"Generated INSERT query: {statements[-1]}")
 
-    # Combine all SELECT statements with UNION ALL
-    union_all_query = " UNION ALL ".join(union_queries)
-    logger.info(f"Generated UNION ALL query: {union_all_query}")
+    logger.info(f"Generated Puppini Bridge SQL: {'; '.join(statements)}")
 
-    # Wrap in CREATE OR REPLACE TABLE statement for Puppini Bridge creation
-    create_table_query = f"CREATE OR REPLACE TABLE puppini_bridge AS {union_all_query}"
-    logger.info(f"Generated Puppini Bridge SQL: {create_table_query}")
+    _write_cache_file(cache_file, json.dumps(statements))
+    logger.info(f"Cached Puppini Bridge SQL to '{cache_file}'.")
 
-    return create_table_query
+    return statements
 
 
 def main():
     database_path = str(DATA_DIR / "sales.duckdb")
-    con, schemas = infer_schemas_and_generate_puppini_bridge_sql(tables, database_path)
+    schemas = infer_schemas(tables, database_path)
+
+    primary_keys = infer_primary_keys(database_path)
 
     print(schemas)
 
-    puppini_bridge_sql = generate_puppini_bridge_sql(schemas)
+    puppini_bridge_sql = generate_puppini_bridge_sql(schemas, primary_keys)
 
-    # Execute the generated SQL in DuckDB to create the Puppini Bridge table
-    con.execute(puppini_bridge_sql)
+    # Execute the generated SQL in DuckDB to create the Puppini Bridge table, one
+    # statement at a time so each stage is inserted separately, reopening the database
+    # writable in place of the read-only connection used for inference
+    close_connection(database_path)
+    con = get_connection(database_path)
+    for statement in puppini_bridge_sql:
+        con.execute(statement)
+    logger.info("Puppini Bridge table created successfully.")
 
 
 if __name__ == "__main__":
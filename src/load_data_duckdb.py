@@ -1,48 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
-import duckdb
+import os
+import tempfile
 from pathlib import Path
-import pandas as pd
+from _db import get_connection
 
 # Define the data directory
 DATA_DIR = Path("data")  # Directory containing the CSV files
+PARQUET_CACHE_DIR = Path(".cache")  # Parquet copies of each CSV, relative to the CSV file
 
 
-def load_csv_to_duckdb(csv_files, force=False, database_path=":memory:"):
+def load_csv_to_duckdb(
+    csv_files, force=False, database_path=":memory:", memory_limit=None
+):
     """
     Load multiple CSV files into DuckDB as tables with auto schema inference.
 
+    Tables are loaded concurrently from cached Parquet copies of the CSV files, without
+    preserving CSV row order.
+
     Args:
         csv_files (dict): A dictionary where keys are table names and values are Path objects pointing to CSV files.
                           Example: {"fact_sales": Path("data/fact_sales.csv"), "dim_product": Path("data/dim_product.csv")}
         database_path (str): Path to the DuckDB database file. Default is in-memory (':memory:').
+        memory_limit (str): Opt-in DuckDB memory limit while loading (e.g. '8GB'), so large
+                            loads spill to disk instead of failing. Default keeps DuckDB's own limit.
 
     Returns:
         duckdb.Connection: A connection to the DuckDB database with the loaded tables.
     """
-    logger.info(f"Connecting to DuckDB database at '{database_path}'...")
-
     if Path(database_path).exists() and not force:
         logger.warning(
             f"DuckDB database '{database_path}' already exists. Connecting to existing. Use 'force=True' to overwrite."
         )
-        return duckdb.connect(database=database_path, read_only=False)
+        return get_connection(database_path)
+
+    con = get_connection(database_path)
+
+    # Let DuckDB skip keeping CSV row order when creating tables and optionally bound
+    # memory, remembering the caller's settings to restore on the shared connection.
+    # DuckDB reports memory_limit to 0.1 units, so it is restored to that precision.
+    load_settings = {"preserve_insertion_order": False}
+    if memory_limit is not None:
+        load_settings["memory_limit"] = memory_limit
+    previous_settings = {
+        name: con.execute("SELECT current_setting(?)", [name]).fetchone()[0]
+        for name in load_settings
+    }
 
-    con = duckdb.connect(database=database_path, read_only=False)
+    def convert_to_parquet(csv_path):
+        parquet_path = csv_path.parent / PARQUET_CACHE_DIR / f"{csv_path.name}.parquet"
+        if (
+            parquet_path.exists()
+            and parquet_path.stat().st_mtime > csv_path.stat().st_mtime
+        ):
+            return parquet_path
+
+        logger.info(f"Converting CSV file '{csv_path}' to '{parquet_path}'...")
+        parquet_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a unique temporary file first so a failed conversion is never cached
+        tmp_fd, tmp_name = tempfile.mkstemp(dir=parquet_path.parent, suffix=".parquet")
+        os.close(tmp_fd)
+        # The COPY target can't be bound, so escape it as a string literal
+        tmp_literal = tmp_name.replace("'", "''")
+        try:
+            with con.cursor() as cursor:
+                # Sample the whole file so the inferred types hold for every row
+                cursor.execute(
+                    f"COPY (SELECT * FROM read_csv_auto(?, sample_size = -1)) TO '{tmp_literal}' (FORMAT PARQUET, CODEC 'zstd')",
+                    [str(csv_path)],
+                )
+            os.replace(tmp_name, parquet_path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        return parquet_path
+
+    def load_table(table_name, parquet_path):
+        logger.info(
+            f"Loading Parquet file '{parquet_path}' into DuckDB table '{table_name}'..."
+        )
+        # Each load runs on its own cursor so the statements can execute concurrently
+        with con.cursor() as cursor:
+            # Table names can't be bound, so quote it as an identifier (escaping embedded
+            # double quotes) and bind the Parquet path instead
+            table_identifier = table_name.replace('"', '""')
+            cursor.execute(
+                f'CREATE TABLE "{table_identifier}" AS SELECT * FROM read_parquet(?)',
+                [str(parquet_path)],
+            )
+        logger.info(f"Table '{table_name}' created successfully.")
+
+    existing_csv_files = {}
     for table_name, csv_path in csv_files.items():
         if not csv_path.exists():
             logger.error(
                 f"CSV file '{csv_path}' does not exist. Skipping table '{table_name}'."
             )
             continue
-
-        logger.info(
-            f"Loading CSV file '{csv_path}' into DuckDB table '{table_name}'..."
-        )
-        query = (
-            f"CREATE TABLE {table_name} AS SELECT * FROM read_csv_auto('{csv_path}')"
-        )
-        con.execute(query)
-        logger.info(f"Table '{table_name}' created successfully.")
+        existing_csv_files[table_name] = csv_path
+
+    if existing_csv_files:
+        for name, value in load_settings.items():
+            con.execute(f"SET {name} = ?", [value])
+        try:
+            max_workers = min(len(existing_csv_files), os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # Convert each distinct CSV file once, even if several tables share it,
+                # then create the tables; consuming the results raises any failure here
+                csv_paths = {path.resolve() for path in existing_csv_files.values()}
+                parquet_paths = dict(
+                    zip(csv_paths, executor.map(convert_to_parquet, csv_paths))
+                )
+                list(
+                    executor.map(
+                        load_table,
+                        existing_csv_files.keys(),
+                        [
+                            parquet_paths[csv_path.resolve()]
+                            for csv_path in existing_csv_files.values()
+                        ],
+                    )
+                )
+        finally:
+            for name, value in previous_settings.items():
+                con.execute(f"SET {name} = ?", [value])
 
     return con
 
@@ -70,7 +152,7 @@ def main():
 
     # Verify that tables are loaded correctly (optional)
     logger.info("Verifying sample data from 'fact_sales' table...")
-    sample_data = con.sql("SELECT * FROM fact_sales").df()
+    sample_data = con.execute("SELECT * FROM fact_sales LIMIT 5").fetchall()
     logger.info(f"Sample data from 'fact_sales': {sample_data}")
 
 